@@ -1,9 +1,15 @@
 import os
+import asyncio
 import csv
+import itertools
+import json
 import random
 import threading
 import time
-from datetime import datetime
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import Callable
 # For GUI
 import tkinter as tk
@@ -23,7 +29,7 @@ from atomacos import NativeUIElement, getAppRefByBundleId
 
 
 class AppConfig:
-    def __init__(self):
+    def __init__(self, load_pack=True):
         self.DEBUG = False
 
         # general setting
@@ -33,6 +39,21 @@ class AppConfig:
             ['mys.png', 'Mystic medal', 280000],
             ['cov.png', 'Covenant bookmark', 184000],
                           ]
+        # extra items can be added to assets/items.csv (file, name, price[, thresholds]) without code edits
+        self.items_manifest = 'items.csv'
+
+        # template matching
+        self.template_scales = (0.5, 0.45, 0.55)  # packed into the asset pack, `bench-match` compares them
+        self.template_scale = 0.5  # used for searching, the UI is smaller or larger on some displays
+        self.match_mode = 'plain'  # see MATCH_MODES, pick with `bench-match`
+        self.match_threshold = None  # None uses the default threshold of match_mode
+        # ORB keypoint matching for frames scoring just below the threshold (rescaled / anti-aliased UI)
+        self.use_feature_fallback = False
+
+        # compiled assets, see build_asset_pack
+        self.asset_pack = AssetPack.load(get_relative_path(ASSET_PACK_FILE)) if load_pack else None
+        if self.asset_pack:
+            self.ALL_ITEMS = self.asset_pack.get_item_list()
 
         # gui
         # color
@@ -45,6 +66,11 @@ class AppConfig:
         self.budget = 100
         self.skip_items = set()
 
+        # debug capture: last frames / match maps kept in memory, saved only on misses, errors and ESC
+        self.debug_screenshot = False
+        self.debug_buffer_size = 40
+        self.debug_buffer_mb = 8
+
 
 def activate_game():
     """
@@ -92,6 +118,165 @@ def get_relative_path(file_name):
     return os.path.join('assets', file_name)
 
 
+def get_history_path(file_name):
+    res_folder = 'ShopRefreshHistory'
+    if not os.path.exists(res_folder):
+        os.makedirs(res_folder)
+    return os.path.join(res_folder, file_name)
+
+
+# mouse animations move in steps of this many seconds
+MOUSE_STEP = 1 / 60
+
+ASSET_PACK_FILE = 'items.pack'
+ASSET_PACK_MAGIC = b'E7PACK'
+ASSET_PACK_VERSION = 3
+
+# name: (cv2 method, use template mask, default threshold, uncertain margin)
+# scores in [threshold - margin, threshold) are near misses that may go to the keypoint matcher; TM_CCORR scores
+# of rows without the item already sit around 0.95, so its band has to be much narrower than the TM_CCOEFF ones
+MATCH_MODES = {
+    'plain': (cv2.TM_CCOEFF_NORMED, False, 0.8, 0.15),
+    'masked': (cv2.TM_CCORR_NORMED, True, 0.97, 0.015),
+    'masked-ccoeff': (cv2.TM_CCOEFF_NORMED, True, 0.8, 0.15),
+}
+
+
+def prepare_item_arrays(path: str, scales) -> dict[str, np.ndarray]:
+    """
+    Decode an item image once and derive everything the refresher needs from it:
+    display icons and grayscale search templates (plain, blurred and mask) for every scale.
+    The mask keeps the item outline (edges inside the alpha channel) so row backgrounds, highlights
+    and quantity badges around the item do not affect masked matching.
+    """
+    rgba = np.array(Image.open(get_relative_path(path)).convert('RGBA'))
+    gray = cv2.cvtColor(rgba, cv2.COLOR_RGBA2GRAY)
+
+    arrays = {
+        'icon': rgba,
+        'show_icon': np.array(Image.fromarray(rgba).resize((45, 45))),
+    }
+    for scale in scales:
+        template = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+        alpha = cv2.resize(rgba[..., 3], (template.shape[1], template.shape[0]), interpolation=cv2.INTER_NEAREST)
+        alpha_mask = np.where(alpha > 0, 255, 0).astype(np.uint8)
+        edge_mask = cv2.dilate(cv2.Canny(template, 50, 150), np.ones((3, 3), np.uint8))
+        mask = cv2.bitwise_and(edge_mask, alpha_mask)
+        if np.count_nonzero(mask) < 0.1 * mask.size:
+            # featureless template, edges are not enough to match on
+            mask = alpha_mask
+
+        arrays[f'template@{scale}'] = template
+        arrays[f'blurred@{scale}'] = cv2.GaussianBlur(template, (3, 3), 0)
+        arrays[f'mask@{scale}'] = mask
+    return arrays
+
+
+def parse_thresholds(value: str) -> dict[str, float]:
+    """
+    Per mode thresholds of a manifest row: 'plain=0.82 masked=0.975'. A bare number was tuned for plain,
+    thresholds do not carry over between modes (TM_CCORR scores sit much higher than TM_CCOEFF ones).
+    """
+    thresholds = {}
+    for part in value.split():
+        mode, _, threshold = part.rpartition('=')
+        thresholds[mode or 'plain'] = float(threshold)
+    return thresholds
+
+
+def read_items_manifest(file_name) -> list[list]:
+    path = get_relative_path(file_name)
+    if not os.path.isfile(path):
+        return []
+
+    with open(path, newline='') as file:
+        rows = [row for row in csv.reader(file) if row and not row[0].startswith('#')]
+    return [[row[0], row[1], int(row[2])] + ([parse_thresholds(row[3])] if len(row) > 3 and row[3] else [])
+            for row in rows]
+
+
+def build_asset_pack(config: 'AppConfig'):
+    """
+    Compile assets/ and config.ALL_ITEMS (plus the items manifest) into a single pack file:
+    magic, header length, JSON header and one blob with all the item arrays.
+    """
+    items = {item[0]: item for item in config.ALL_ITEMS}
+    for item in read_items_manifest(config.items_manifest):
+        items[item[0]] = item
+
+    header = {'version': ASSET_PACK_VERSION, 'scales': list(config.template_scales), 'items': []}
+    blobs = []
+    offset = 0
+    for path, name, price, *thresholds in items.values():
+        entry = {'path': path, 'name': name, 'price': price,
+                 'thresholds': thresholds[0] if thresholds else {},
+                 'arrays': {}}
+        for key, item_array in prepare_item_arrays(path, config.template_scales).items():
+            data = np.ascontiguousarray(item_array, dtype=np.uint8).tobytes()
+            entry['arrays'][key] = [offset, list(item_array.shape)]
+            blobs.append(data)
+            offset += len(data)
+        header['items'].append(entry)
+        print(f'Packed {name} ({path})')
+
+    header_bytes = json.dumps(header).encode()
+    path = get_relative_path(ASSET_PACK_FILE)
+    with open(path, 'wb') as file:
+        file.write(ASSET_PACK_MAGIC)
+        file.write(len(header_bytes).to_bytes(4, 'little'))
+        file.write(header_bytes)
+        for data in blobs:
+            file.write(data)
+    print(f'Asset pack saved to {path}, {len(header["items"])} items')
+
+
+class AssetPack:
+    """Read-only view of a compiled asset pack, all arrays point into one memory map of the file."""
+    def __init__(self, header: dict, data: np.ndarray):
+        self.scales = header['scales']
+        self.items = header['items']
+        self._data = data
+
+    @staticmethod
+    def load(path) -> 'AssetPack | None':
+        if not os.path.isfile(path):
+            return None
+        try:
+            raw = np.memmap(path, dtype=np.uint8, mode='r')
+            if raw[:len(ASSET_PACK_MAGIC)].tobytes() != ASSET_PACK_MAGIC:
+                raise Exception('bad magic')
+            start = len(ASSET_PACK_MAGIC) + 4
+            header_length = int.from_bytes(raw[len(ASSET_PACK_MAGIC):start].tobytes(), 'little')
+            header = json.loads(raw[start:start + header_length].tobytes())
+            if header.get('version') != ASSET_PACK_VERSION:
+                raise Exception(f'unsupported version {header.get("version")}')
+            return AssetPack(header, raw[start + header_length:])
+        except Exception as e:
+            print(f'⚠️  Ignoring asset pack {path}: {e}')
+            return None
+
+    def get_item_list(self) -> list[list]:
+        return [[item['path'], item['name'], item['price']] for item in self.items]
+
+    def get_item(self, path: str) -> dict | None:
+        return next((item for item in self.items if item['path'] == path), None)
+
+    def get_arrays(self, path: str) -> dict[str, np.ndarray] | None:
+        item = self.get_item(path)
+        if item is None:
+            return None
+        arrays = {}
+        for key, (offset, shape) in item['arrays'].items():
+            size = int(np.prod(shape))
+            arrays[key] = self._data[offset:offset + size].reshape(shape)
+        return arrays
+
+    def get_threshold(self, path: str, mode: str) -> float | None:
+        """Threshold tuned for mode, None if the item has none for it."""
+        item = self.get_item(path)
+        return item['thresholds'].get(mode) if item else None
+
+
 def validate_float(value, action):
     if action != '1':
         return True
@@ -114,38 +299,240 @@ def validate_int(value):
 
 
 class ShopItem:
-    def __init__(self, path='', show_image=None, search_image=None, price=0, count=0):
+    """
+    Search data and purchase count of an item. Display images live in RefreshStatistic, the count is a slot
+    in the statistic's counter array once the item is added there (see bind_counter).
+    """
+    __slots__ = ('path', 'search_image', 'blurred_image', 'mask', 'threshold', 'keypoints', 'descriptors', 'price',
+                 '_counts', '_index')
+
+    def __init__(self, path='', search_image=None, price=0, count=0, blurred_image=None, mask=None, threshold=0.8):
         self.path = path
-        self.show_image = show_image
         self.search_image = search_image
+        self.blurred_image = blurred_image
+        self.mask = mask
+        self.threshold = threshold
+        # ORB features of search_image, see compute_item_features
+        self.keypoints = None
+        self.descriptors = None
         self.price = price
-        self.count = count
+        self._counts = array('q', [count])
+        self._index = 0
+
+    @property
+    def count(self) -> int:
+        return self._counts[self._index]
+
+    @count.setter
+    def count(self, value: int):
+        self._counts[self._index] = value
+
+    def bind_counter(self, counts: array, index: int):
+        counts[index] = self.count
+        self._counts, self._index = counts, index
+
+    def __repr__(self):
+        return (f'ShopItem(path={self.path}, search_image={self.search_image},'
+                f' price={self.price}, count={self.count}, threshold={self.threshold}')
+
+
+def load_shop_item(path: str, price=0, count=0, asset_pack: AssetPack = None, scale=0.5, mode='plain',
+                   threshold=None) -> ShopItem:
+    """
+    Create a shop item from the asset pack (or the loose png).
+    Threshold priority: explicit argument, per item threshold tuned for mode in the pack, default of the mode.
+    """
+    arrays = asset_pack.get_arrays(path) if asset_pack else None
+    if arrays is not None and f'template@{scale}' in arrays:
+        if threshold is None:
+            threshold = asset_pack.get_threshold(path, mode)
+    else:
+        # no compiled pack, decode the loose png
+        arrays = prepare_item_arrays(path, [scale])
+
+    if threshold is None:
+        threshold = MATCH_MODES[mode][2]
+
+    return ShopItem(path, search_image=arrays[f'template@{scale}'], blurred_image=arrays[f'blurred@{scale}'],
+                    mask=arrays[f'mask@{scale}'], threshold=threshold, price=price, count=count)
+
+
+def load_item_icon(path: str, asset_pack: AssetPack = None) -> Image.Image:
+    arrays = asset_pack.get_arrays(path) if asset_pack else None
+    if arrays is not None:
+        return Image.fromarray(arrays['show_icon'])
+    return Image.open(get_relative_path(path)).resize((45, 45))
+
+
+def match_item(process_screenshot: np.ndarray, item: ShopItem, mode='plain') -> np.ndarray:
+    """Correlation map of the (blurred) item template over the blurred screenshot."""
+    method, masked, _, _ = MATCH_MODES[mode]
+    process_item = item.blurred_image
+    if process_item is None:
+        process_item = cv2.GaussianBlur(item.search_image, (3, 3), 0)
+
+    if masked and item.mask is not None:
+        result = cv2.matchTemplate(process_screenshot, process_item, method, mask=item.mask)
+        # masked correlation divides by zero on flat areas
+        return np.nan_to_num(result, copy=False, nan=0, posinf=0, neginf=0)
+    return cv2.matchTemplate(process_screenshot, process_item, method)
+
+
+def benchmark_matching(corpus_dir: str, config: 'AppConfig', recall_target=0.98, tolerance=5,
+                       max_false_positives=0):
+    """
+    Compare match modes and thresholds on a replay corpus: a folder with captured frames and labels.csv
+    (file, item path, y of the item top-left corner in pixels; one row per item present on the frame).
+    Every template scale of the asset pack is tried with every mode. Prints recall, false positives and
+    matching time, then the cheapest configuration reaching recall_target with at most max_false_positives
+    (a false positive buys the wrong row); fastest first, fewer false positives and then the higher threshold
+    break ties.
+    """
+    labels = {}
+    with open(os.path.join(corpus_dir, 'labels.csv'), newline='') as file:
+        for row in csv.reader(file):
+            if row and row[0] != 'file':
+                labels.setdefault(row[0], {})[row[1]] = int(row[2])
+
+    frames = {}
+    for file_name in sorted(os.listdir(corpus_dir)):
+        if file_name.lower().endswith('.png'):
+            frames[file_name] = cv2.GaussianBlur(cv2.imread(os.path.join(corpus_dir, file_name), cv2.IMREAD_GRAYSCALE),
+                                                 (3, 3), 0)
+    if not frames:
+        print('No frames found in', corpus_dir)
+        return
+
+    scales = config.asset_pack.scales if config.asset_pack else config.template_scales
+    positives = sum(len(labels.get(name, {})) for name in frames)
+    results = []
+
+    for scale, (mode, (_, _, default_threshold, _)) in itertools.product(scales, MATCH_MODES.items()):
+        items = [load_shop_item(path, asset_pack=config.asset_pack, scale=scale, mode=mode)
+                 for path, *_ in config.ALL_ITEMS]
+        maps = []
+        started = time.perf_counter()
+        for name, frame in frames.items():
+            for item in items:
+                maps.append((labels.get(name, {}).get(item.path), match_item(frame, item, mode)))
+        elapsed_ms = (time.perf_counter() - started) * 1000 / (len(frames) * len(items))
+
+        for threshold in np.arange(default_threshold - 0.1, min(default_threshold + 0.05, 1.0), 0.01):
+            hits = false_positives = 0
+            for expected_y, result in maps:
+                loc = np.where(result >= threshold)
+                found = loc[0].size > 0
+                if found and expected_y is not None and abs(int(loc[0][0]) - expected_y) <= tolerance:
+                    hits += 1
+                elif found:
+                    false_positives += 1
+            recall = hits / positives if positives else 1.0
+            results.append((scale, mode, float(threshold), recall, false_positives, elapsed_ms))
+
+    print(f'{"scale":<7}{"mode":<15}{"threshold":>10}{"recall":>8}{"false +":>9}{"ms/search":>11}')
+    for scale, mode, threshold, recall, false_positives, elapsed_ms in results:
+        print(f'{scale:<7}{mode:<15}{threshold:>10.2f}{recall:>8.3f}{false_positives:>9}{elapsed_ms:>11.2f}')
+
+    good = [r for r in results if r[3] >= recall_target and r[4] <= max_false_positives]
+    if not good:
+        print(f'No configuration reaches recall {recall_target} with at most {max_false_positives} false positives')
+        return
+    scale, mode, threshold, recall, false_positives, elapsed_ms = min(good, key=lambda r: (r[5], r[4], -r[2]))
+    print(f'Recommended: template_scale={scale}, match_mode={mode!r}, match_threshold={threshold:.2f} '
+          f'(recall {recall:.3f}, {false_positives} false positives, {elapsed_ms:.2f} ms/search)')
+
+
+def create_feature_detector():
+    # templates are only ~35px wide, so use small patches and a shallow pyramid
+    return cv2.ORB_create(nfeatures=500, scaleFactor=1.2, nlevels=3, edgeThreshold=7, patchSize=7, fastThreshold=10)
+
+
+def compute_item_features(detector, item: ShopItem):
+    item.keypoints, item.descriptors = detector.detectAndCompute(item.search_image, None)
+
+
+def match_item_features(frame_features: tuple, item: ShopItem, min_matches=6, tolerance=6) -> int | None:
+    """
+    Locate the item on a frame with ORB keypoints, frame_features is the detectAndCompute result of the frame
+    (computed once per frame for all items). Returns the y of the template top-left corner if enough matches
+    agree on it, otherwise None.
+    """
+    if item.descriptors is None or len(item.keypoints) < min_matches:
+        return None
+
+    keypoints, descriptors = frame_features
+    if descriptors is None or len(keypoints) < 2:
+        return None
+
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(item.descriptors, descriptors, k=2)
+    good = [pair[0] for pair in matches if len(pair) == 2 and pair[0].distance < 0.8 * pair[1].distance]
+    if len(good) < min_matches:
+        return None
+
+    offsets = np.array([keypoints[m.trainIdx].pt[1] - item.keypoints[m.queryIdx].pt[1] for m in good])
+    y = float(np.median(offsets))
+    if np.count_nonzero(np.abs(offsets - y) <= tolerance) < min_matches:
+        return None
+    return int(round(y))
+
+
+class MatchTierStats:
+    __slots__ = ('calls', 'hits', 'seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.seconds = 0.0
+
+    def record(self, hit: bool, seconds: float):
+        self.calls += 1
+        self.hits += int(hit)
+        self.seconds += seconds
 
     def __repr__(self):
-        return (f'ShopItem(path={self.path}, show_image={self.show_image}, search_image={self.search_image},'
-                f' price={self.price}, count={self.count}')
+        if not self.calls:
+            return 'not used'
+        return (f'{self.hits}/{self.calls} hits ({self.hits / self.calls:.1%}),'
+                f' {self.seconds / self.calls * 1000:.1f} ms avg')
 
 
 class RefreshStatistic:
+    __slots__ = ('refresh_count', 'items', 'counts', 'show_images', 'start_time', 'run_start_time', 'active_time',
+                 'downtime', 'idle_time', 'purchase_mismatches', 'match_tiers', 'events')
+
     def __init__(self):
         self.refresh_count = 0
         self.items = {}
+        # item counts, one slot per item in self.items order
+        self.counts = array('q')
+        # display assets (Tk images) are kept apart from the runtime state
+        self.show_images = {}
         self.start_time = datetime.now()
+        # a resumed session only counts the time the refresher ran: earlier runs plus this one
+        self.run_start_time = self.start_time
+        self.active_time = 0.0
+        self.downtime = 0.0
+        self.idle_time = 0.0
+        self.purchase_mismatches = 0
+        self.match_tiers = {'template': MatchTierStats(), 'features': MatchTierStats()}
+        self.events = []
 
     def update_time(self):
-        self.start_time = datetime.now()
+        self.start_time = self.run_start_time = datetime.now()
+        self.active_time = 0.0
 
-    def add_shop_item(self, path: str, name='', price=0, count=0):
-        relative_path = get_relative_path(path)
-        image = Image.open(relative_path).resize((45, 45))
-        image = ImageTk.PhotoImage(image)
+    def get_duration(self) -> timedelta:
+        return timedelta(seconds=self.active_time) + (datetime.now() - self.run_start_time)
 
-        image2 = cv2.imread(relative_path)
-        image2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
-        # if path == 'mys.png':
-        #     image2 = cv2.resize(image2, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR)
-        image2 = cv2.resize(image2, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_LINEAR)
-        self.items[name] = ShopItem(path, show_image=image, search_image=image2, price=price, count=count)
+    def add_shop_item(self, path: str, name='', price=0, count=0, asset_pack: AssetPack = None,
+                      scale=0.5, mode='plain', threshold=None):
+        self.add_item(name, load_shop_item(path, price, count, asset_pack, scale, mode, threshold))
+        self.show_images[name] = ImageTk.PhotoImage(load_item_icon(path, asset_pack))
+
+    def add_item(self, name: str, item: ShopItem):
+        self.counts.append(0)
+        item.bind_counter(self.counts, len(self.counts) - 1)
+        self.items[name] = item
 
     def get_inventory(self):
         return self.items
@@ -154,7 +541,7 @@ class RefreshStatistic:
         return list(self.items.keys())
 
     def get_show_images(self):
-        return [_.show_image for _ in self.items.values()]
+        return [self.show_images[name] for name in self.items if name in self.show_images]
 
     def get_paths(self):
         return [_.path for _ in self.items.values()]
@@ -168,17 +555,21 @@ class RefreshStatistic:
     def increment_refresh_count(self):
         self.refresh_count += 1
 
-    def write_to_csv(self):
-        res_folder = 'ShopRefreshHistory'
-        if not os.path.exists(res_folder):
-            os.makedirs(res_folder)
+    def add_downtime(self, seconds: float):
+        self.downtime += seconds
+
+    def log_event(self, kind: str, message=''):
+        print(f'[{kind}] {message}')
+        self.events.append((datetime.now(), kind, message))
 
+    def get_history_name(self):
         gen_path = 'refreshAttempt'
         for name in self.get_names():
             gen_path += name[:4]
-        gen_path += '.csv'
+        return gen_path
 
-        path = os.path.join(res_folder, gen_path)
+    def write_to_csv(self):
+        path = get_history_path(self.get_history_name() + '.csv')
 
         if not os.path.isfile(path):
             with open(path, 'w', newline='') as file:
@@ -187,13 +578,244 @@ class RefreshStatistic:
                 column_names.extend(self.get_names())
                 writer.writerow(column_names)
 
+        data = [self.start_time, self.get_duration(), self.refresh_count, self.refresh_count * 3,
+                self.get_total_cost()]
+        data.extend(self.get_item_counts())
+
+        with open(path, newline='') as file:
+            rows = list(csv.reader(file))
+        if len(rows) > 1 and rows[-1][0] == str(self.start_time):
+            # resumed session, update its row instead of adding one
+            rows[-1] = data
+            with open(path, 'w', newline='') as file:
+                csv.writer(file).writerows(rows)
+            return
+
         with open(path, 'a', newline='') as file:
             writer = csv.writer(file)
-            data = [self.start_time, datetime.now() - self.start_time, self.refresh_count, self.refresh_count * 3,
-                    self.get_total_cost()]
-            data.extend(self.get_item_counts())
             writer.writerow(data)
 
+    def get_snapshot_path(self):
+        return get_history_path(self.get_history_name() + '_session.json')
+
+    def save_snapshot(self):
+        """Write the session counters next to the history CSV (atomically, so a crash never leaves half a file)."""
+        snapshot = {
+            'start_time': self.start_time.isoformat(),
+            'saved_at': datetime.now().isoformat(),
+            'active_time': self.get_duration().total_seconds(),
+            'refresh_count': self.refresh_count,
+            'counts': dict(zip(self.get_names(), self.counts.tolist())),
+            'downtime': self.downtime,
+            'purchase_mismatches': self.purchase_mismatches,
+        }
+        path = self.get_snapshot_path()
+        with open(path + '.tmp', 'w') as file:
+            json.dump(snapshot, file)
+        os.replace(path + '.tmp', path)
+
+    def resume(self) -> bool:
+        """Continue the last saved session of the same items. Returns False if there is nothing to resume."""
+        path = self.get_snapshot_path()
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path) as file:
+                snapshot = json.load(file)
+            self.start_time = datetime.fromisoformat(snapshot['start_time'])
+            self.run_start_time = datetime.now()
+            # the time between the last save and a crash is lost, like the refreshes in it
+            self.active_time = snapshot['active_time']
+            self.refresh_count = snapshot['refresh_count']
+            self.downtime = snapshot['downtime']
+            self.purchase_mismatches = snapshot['purchase_mismatches']
+            for name, count in snapshot['counts'].items():
+                if name in self.items:
+                    self.items[name].count = count
+        except Exception as e:
+            print(f'Failed to resume session from {path}: {e}')
+            return False
+        return True
+
+    def write_events(self):
+        if not self.events:
+            return
+        # events logged while writing go to the next write
+        events, self.events = self.events, []
+
+        path = get_history_path('events.csv')
+        is_new = not os.path.isfile(path)
+        with open(path, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if is_new:
+                writer.writerow(['Session', 'Time', 'Event', 'Message'])
+            for event_time, kind, message in events:
+                writer.writerow([self.start_time, event_time, kind, message])
+
+
+class ScreenState:
+    SHOP_LIST = 'shop list'
+    CONFIRM_DIALOG = 'confirm dialog'
+    UNKNOWN = 'unknown'
+    NO_FRAME = 'no frame'  # capture missed its deadline
+
+
+class ScreenWatchdog:
+    """
+    Classifies captured frames as shop list, refresh confirm dialog or unknown screen.
+    The shop list is recognised by its reference signature (a small grayscale histogram and a tiny
+    layout thumbnail of the whole frame), the confirm dialog by a template of its confirm button area,
+    so other dialogs and dimmed lists are never taken for it. Both cost well under a millisecond.
+    """
+    def __init__(self, threshold=0.7, max_recoveries=3, pause_time=30.0, max_pauses=3, max_recaptures=5):
+        self.threshold = threshold
+        self.max_recoveries = max_recoveries
+        # missing frames are recaptured with doubling waits, nothing is clicked on a screen that was not seen
+        self.max_recaptures = max_recaptures
+        self.pause_time = pause_time
+        self.max_pauses = max_pauses
+        # window-relative points clicked in turn to dismiss popups / network error dialogs: the back button
+        # and the title bar, away from every confirm button so recovery can never buy or refresh
+        self.recovery_points = [(0.03, 0.05), (0.50, 0.03)]
+        # x, y, width, height of the refresh confirm button area, relative to the window
+        self.confirm_roi = (0.46, 0.58, 0.24, 0.14)
+        self.confirm_threshold = 0.9
+        self.confirm_template: np.ndarray | None = None
+        self.signatures = {}
+
+    @staticmethod
+    def signature(frame: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        small = cv2.resize(frame, (160, 90), interpolation=cv2.INTER_AREA)
+        hist = cv2.calcHist([small], [0], None, [32], [0, 256])
+        cv2.normalize(hist, hist)
+        layout = cv2.resize(small, (32, 18), interpolation=cv2.INTER_AREA).astype(np.float32)
+        return hist, layout
+
+    @staticmethod
+    def crop(frame: np.ndarray, roi: tuple[float, float, float, float], margin=0) -> np.ndarray:
+        height, width = frame.shape[:2]
+        x, y = int(width * roi[0]) - margin, int(height * roi[1]) - margin
+        w, h = int(width * roi[2]) + 2 * margin, int(height * roi[3]) + 2 * margin
+        return frame[max(0, y):y + h, max(0, x):x + w]
+
+    def learn(self, state: str, frame: np.ndarray):
+        if state == ScreenState.CONFIRM_DIALOG:
+            self.confirm_template = self.crop(frame, self.confirm_roi).copy()
+        else:
+            self.signatures[state] = self.signature(frame)
+
+    def knows(self, state: str) -> bool:
+        if state == ScreenState.CONFIRM_DIALOG:
+            return self.confirm_template is not None
+        return state in self.signatures
+
+    def shows_confirm(self, frame: np.ndarray, template: np.ndarray = None) -> bool:
+        """True if the confirm button area of the frame matches the template (a few pixels of shift allowed)."""
+        template = self.confirm_template if template is None else template
+        if template is None:
+            return False
+        area = self.crop(frame, self.confirm_roi, margin=8)
+        if area.shape[0] < template.shape[0] or area.shape[1] < template.shape[1]:
+            return False
+        result = cv2.matchTemplate(area, template, cv2.TM_CCOEFF_NORMED)
+        return float(np.nan_to_num(result).max()) >= self.confirm_threshold
+
+    def list_changed(self, before: np.ndarray, after: np.ndarray, list_roi: tuple[float, float, float, float],
+                     min_changed=0.005) -> bool:
+        """True if at least min_changed of the item list area differs by more than capture noise."""
+        changed = cv2.absdiff(self.crop(before, list_roi), self.crop(after, list_roi)) > 24
+        return np.count_nonzero(changed) >= min_changed * changed.size
+
+    def classify(self, frame: np.ndarray | None) -> str:
+        if frame is None:
+            return ScreenState.NO_FRAME
+        if self.shows_confirm(frame):
+            return ScreenState.CONFIRM_DIALOG
+
+        hist, layout = self.signature(frame)
+
+        best_state, best_score = ScreenState.UNKNOWN, self.threshold
+        for state, (ref_hist, ref_layout) in self.signatures.items():
+            hist_score = cv2.compareHist(hist, ref_hist, cv2.HISTCMP_CORREL)
+            layout_score = 1 - float(np.mean(np.abs(layout - ref_layout))) / 255
+            # sold out rows shift the histogram a lot but barely change the layout, dialogs and popups change both
+            score = (hist_score + layout_score) / 2
+            if score >= best_score:
+                best_state, best_score = state, score
+        return best_state
+
+
+class DebugRecorder:
+    """
+    Ring buffer of the last captured frames, match maps and decisions. Frames are kept downscaled to max_width
+    and match maps as uint8, the buffer holds at most capacity entries and max_bytes of images.
+    PNG encoding happens on a background thread when dump is called, at most once per min_dump_interval
+    seconds for each reason.
+    """
+    def __init__(self, capacity=40, folder='debug_screenshots', max_width=480, max_bytes=8 * 1024 * 1024,
+                 min_dump_interval=60.0):
+        self.folder = folder
+        self.capacity = capacity
+        self.max_width = max_width
+        self.max_bytes = max_bytes
+        self.min_dump_interval = min_dump_interval
+        self.entries = deque()
+        self._bytes = 0
+        self._last_dump = {}
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='debug-writer')
+
+    def shrink(self, image: np.ndarray) -> np.ndarray:
+        if image.shape[1] <= self.max_width:
+            return image
+        height = max(1, image.shape[0] * self.max_width // image.shape[1])
+        return cv2.resize(image, (self.max_width, height), interpolation=cv2.INTER_AREA)
+
+    def record(self, label: str, image: np.ndarray = None, match_map: np.ndarray = None, **decision):
+        if image is not None:
+            image = self.shrink(image)
+        if match_map is not None:
+            match_map = self.shrink(cv2.normalize(match_map, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U))
+        size = sum(data.nbytes for data in (image, match_map) if data is not None)
+
+        with self._lock:
+            self.entries.append((time.time(), label, image, match_map, decision, size))
+            self._bytes += size
+            while len(self.entries) > self.capacity or (self._bytes > self.max_bytes and len(self.entries) > 1):
+                self._bytes -= self.entries.popleft()[-1]
+
+    def dump(self, reason: str) -> Future | None:
+        now = time.time()
+        with self._lock:
+            if not self.entries or now - self._last_dump.get(reason, -self.min_dump_interval) < self.min_dump_interval:
+                return None
+            self._last_dump[reason] = now
+            entries = list(self.entries)
+            self.entries.clear()
+            self._bytes = 0
+        return self._writer.submit(self._write, reason, entries)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+
+    def _write(self, reason: str, entries: list):
+        try:
+            folder = os.path.join(self.folder, f'{int(time.time() * 1000)}_{reason}')
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, 'decisions.csv'), 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['Index', 'Time', 'Label', 'Decision'])
+                for index, (timestamp, label, image, match_map, decision, _) in enumerate(entries):
+                    base_name = os.path.join(folder, f'{index:03d}_{label.replace(".", "_")}')
+                    if image is not None:
+                        cv2.imwrite(base_name + '.png', image)
+                    if match_map is not None:
+                        cv2.imwrite(base_name + '_result.png', cv2.applyColorMap(match_map, cv2.COLORMAP_JET))
+                    writer.writerow([index, datetime.fromtimestamp(timestamp), label, json.dumps(decision)])
+            print(f'Saved debug capture ({reason}) to {folder}')
+        except Exception as e:
+            print('Failed to save debug capture:', e)
+
 
 class SecretShopRefresh:
     def __init__(self, title_name: str, terminate_callback: Callable[[], None], settings_window: tk = None,
@@ -202,20 +824,49 @@ class SecretShopRefresh:
         # init state
         self.debug = debug
         self.debug_screenshot = False
+        self.debug_recorder = DebugRecorder()
         self.is_stop_refresh = False
         self.mouse_sleep = 0.3
         self.screenshot_sleep = 0.3
+        self.match_mode = 'plain'
+        self.use_feature_fallback = False  # runs for scores in the uncertain band of the mode, see MATCH_MODES
+        self.list_roi = (0.0, 0.1, 0.6, 0.8)  # x, y, width, height of the item list, relative to the window
+        self.feature_detector = create_feature_detector()
         self.terminate_callback = terminate_callback
         self.budget = budget
+        # session state is saved every snapshot_every refreshes (and after purchases) for resume
+        self.resume = False
+        self.snapshot_every = 10
 
         # find window
         self.game_window: NativeUIElement = find_window(title_name)
         self.settings_window = settings_window
         self.statistic_calculator = RefreshStatistic()
+        self.watchdog = ScreenWatchdog()
+
+        # purchase verification runs next to the following actions
+        self.sold_out_dimming = 0.8
+        # x, y, width, height of the refresh button area below the list, relative to the window
+        self.control_roi = (0.10, 0.91, 0.20, 0.06)
+        self._pending_verifications: list[tuple[str, asyncio.Task]] = []
+        # held while a purchase dialog is open, checks must not capture the dialog instead of the row
+        self._purchase_lock = asyncio.Lock()
+
+        # deadline for blocking steps (capture, matching) run off the event loop, one at a time on _step_executor
+        self.step_timeout = 5.0
+        self._step_executor: ThreadPoolExecutor | None = None
+        self._late_step: asyncio.Future | None = None
+        # snapshot and event log writes run next to the following refresh
+        self._flush_task: asyncio.Task | None = None
+        # how often the screen is checked while waiting for the game, e.g. for a new shop after refreshing
+        self.poll_interval = 0.1
 
         # stop control and worker thread
         self._stop_event = threading.Event()
+        self._stop_requested_at: float | None = None
         self._thread: threading.Thread | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
 
         # Global keyboard listener for ESC key
         self._event_monitor = None
@@ -240,7 +891,7 @@ class SecretShopRefresh:
 
                 if keycode == 53:  # ESC key
                     print("🛑 ESC pressed - stopping refresh...")
-                    self._stop_event.set()
+                    self.request_stop()
 
             except Exception as e:
                 if self.debug:
@@ -295,9 +946,27 @@ class SecretShopRefresh:
         self._thread = threading.Thread(target=self.shop_refresh_loop, daemon=True)
         self._thread.start()
 
-    def stop(self):
+    def request_stop(self):
+        """Stop the refresh loop from any thread, the running step is cancelled right away."""
+        if self._stop_event.is_set():
+            return
+        self._stop_requested_at = time.perf_counter()
         self._stop_event.set()
 
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._cancel_task)
+            except RuntimeError:
+                pass  # loop already finished
+
+    def _cancel_task(self):
+        # runs on the event loop; _task is cleared before the session cleanup, which must not be cancelled
+        if self._task is not None:
+            self._task.cancel()
+
+    def stop(self):
+        self.request_stop()
+
         if self._thread and self._thread.is_alive():
             self._thread.join(timeout=2)
 
@@ -309,9 +978,9 @@ class SecretShopRefresh:
         print('Taking screenshot at region:', region)
         screenshot = ImageGrab.grab(bbox=(left, top, left + width, top + height),
                                     all_screens=True)
-        screenshot.save('debug_screenshot.png')
         screenshot = np.array(screenshot)
         screenshot = cv2.cvtColor(screenshot, cv2.COLOR_BGR2GRAY)
+        if self.debug_screenshot: self.debug_recorder.record('screenshot', screenshot)
         return screenshot
 
     def take_screenshot_mss(self) -> np.ndarray:
@@ -319,17 +988,41 @@ class SecretShopRefresh:
         left, top, width, height = safe_get_window_param(self.game_window)
         monitor = {"left": int(left), "top": int(top), "width": int(width), "height": int(height)}
         with mss.mss() as sct:
-            sct_img = sct.grab(monitor)  # raw BGRA
-            arr = np.array(sct_img)  # shape (h, w, 4)
-            if arr.ndim == 3 and arr.shape[2] == 4:
-                bgr = cv2.cvtColor(arr, cv2.COLOR_BGRA2BGR)
-            else:
-                bgr = arr[..., :3]
-            gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+            gray = self.grab_gray(sct, monitor)
+            if self.debug_screenshot: self.debug_recorder.record('screenshot', gray)
             return gray
 
+    def take_regions_mss(self, *regions: tuple[int, int, int, int]) -> list[np.ndarray]:
+        """Capture only the given regions (x, y, width, height relative to the window)."""
+        left, top, _, _ = safe_get_window_param(self.game_window)
+        with mss.mss() as sct:
+            grays = [self.grab_gray(sct, {"left": int(left + x), "top": int(top + y), "width": int(w),
+                                          "height": int(h)}) for x, y, w, h in regions]
+            if self.debug_screenshot:
+                for region, gray in zip(regions, grays):
+                    self.debug_recorder.record('region', gray, region=region)
+            return grays
+
+    @staticmethod
+    def grab_gray(sct, monitor: dict) -> np.ndarray:
+        sct_img = sct.grab(monitor)  # raw BGRA
+        arr = np.array(sct_img)  # shape (h, w, 4)
+        if arr.ndim == 3 and arr.shape[2] == 4:
+            bgr = cv2.cvtColor(arr, cv2.COLOR_BGRA2BGR)
+        else:
+            bgr = arr[..., :3]
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+
     def shop_refresh_loop(self):
+        """Sync facade for the GUI worker thread: runs the asyncio refresh loop until it ends or is stopped."""
+        asyncio.run(self.run_refresh_loop())
+
+    async def run_refresh_loop(self):
         print('Start shop refreshing loop ...')
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._step_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shop-step')
+
         activate_game()
         # Show statistics widget
         hint, mini_labels, refresh_label = self.show_statistics_widget()
@@ -338,94 +1031,225 @@ class SecretShopRefresh:
             for label, count in zip(mini_labels, self.statistic_calculator.get_item_counts()):
                 label.config(text=count)
 
-        def search_and_buy():
+        async def search_and_buy(screenshot: np.ndarray = None):
+            """screenshot: a frame of the settled list if the caller already has one."""
             if self._stop_event.is_set():  # Check for stop at start
                 return
 
             if self.debug: print('Searching for items to buy ...')
 
-            time.sleep(self.screenshot_sleep)
-            screenshot = self.take_screenshot_mss()
-
-            for key, shop_item in self.statistic_calculator.get_inventory().items():
-                if self._stop_event.is_set():  # Check during iteration
-                    return
-
-                if key in bought: continue
-                if self.debug: print('Searching for item:', key)
+            if screenshot is None:
+                await self.settle(self.screenshot_sleep)
+                screenshot = await self.capture()
+            screenshot = await self.ensure_shop_list(screenshot)
+            if screenshot is None:
+                return
 
-                item_pos = self.search_item(screenshot, shop_item)
+            wanted = [(key, shop_item) for key, shop_item in self.statistic_calculator.get_inventory().items()
+                      if key not in bought]
+            positions = await self.step(self.search_items, screenshot, [shop_item for _, shop_item in wanted])
+            if positions is None:
+                return
 
+            for (key, shop_item), item_pos in zip(wanted, positions):
                 if item_pos is not None:
                     if self.debug: print(f'Found item {key} at:', item_pos)
 
                     if self._stop_event.is_set():  # Check before clicking
                         return
 
-                    if self.click_buy(item_pos):
+                    if await self.click_buy(item_pos):
                         shop_item.count += 1
                         bought.add(key)
+                        self.verify_purchase(key, screenshot, item_pos)
 
                     if hint: update_statistics_widget()
 
-        time.sleep(self.mouse_sleep)
-
         try:
-            self.statistic_calculator.update_time()
+            await self.settle(self.mouse_sleep)
+
+            if self.resume and self.statistic_calculator.resume():
+                print(f'Resuming session from {self.statistic_calculator.start_time}')
+                if hint:
+                    update_statistics_widget()
+                    refresh_label.config(text=str(self.statistic_calculator.refresh_count))
+            else:
+                self.statistic_calculator.update_time()
             sliding_time = max(0.7 + self.screenshot_sleep, 1)
 
+            # The game is expected to show the shop list when refreshing starts
+            await self.settle(self.screenshot_sleep)
+            screenshot = await self.capture()
+            if screenshot is None:
+                raise Exception('No frame of the shop list to start from')
+            self.watchdog.learn(ScreenState.SHOP_LIST, screenshot)
+
+            # settled frame of a new shop, click_refresh waits for it instead of a fixed sliding time
+            new_list = None
+            # rows bought on the current list, kept when refreshing fails so sold out rows are not bought again
+            bought = set()
+
             # Loop through shop
             while not self._stop_event.is_set():
-                bought = set()
-
-                time.sleep(sliding_time)
+                if new_list is None:
+                    await self.settle(sliding_time)
 
                 if self.debug: print('start of bundle refresh')
 
-                # Check for stop before each major operation
-                if self._stop_event.is_set():
-                    break
-
-                search_and_buy()
+                await search_and_buy(new_list)
+                new_list = None
 
+                # stops from inside the loop (ensure_shop_list gave up) only set the event, nothing is cancelled
                 if self._stop_event.is_set():
                     break
 
-                self.scroll_down()
+                # rows move with scrolling and refreshing, scroll_down lets bought rows be checked first
+                await self.scroll_down()
+                if await self.collect_purchase_verifications() and hint: update_statistics_widget()
 
                 if self._stop_event.is_set():
                     break
 
-                search_and_buy()
+                await search_and_buy()
 
                 if self.debug: print(f'Finished searching for items to buy, bought {bought} items, refresh shop now.')
-                if self.debug: time.sleep(5)
+                if self.debug: await self.settle(5)
 
                 if self._stop_event.is_set() or (self.budget and
                                                  self.statistic_calculator.refresh_count >= self.budget):
                     break
 
-                if not self.is_stop_refresh: self.click_refresh()
+                if await self.collect_purchase_verifications(wait=True) and hint: update_statistics_widget()
+
+                if not self.is_stop_refresh:
+                    new_list = await self.click_refresh()
+                    if new_list is None:
+                        continue
                 self.statistic_calculator.increment_refresh_count()
                 if hint: refresh_label.config(text=str(self.statistic_calculator.refresh_count))
-                time.sleep(self.mouse_sleep)
 
+                if bought or self.statistic_calculator.refresh_count % self.snapshot_every == 0:
+                    await self.flush_session()
+                bought = set()
+
+        except asyncio.CancelledError:
+            print('Refresh loop cancelled')
         except Exception as e:
             print(f"Error in shop_refresh_loop: {e}")
             import traceback
             traceback.print_exc()
+            if self.debug_screenshot: self.debug_recorder.dump('error')
         finally:
+            # a stop request from now on must not cancel the cleanup below
+            self._task = None
+            if self._stop_requested_at is not None:
+                stop_latency = time.perf_counter() - self._stop_requested_at
+                self.statistic_calculator.log_event('stopped', f'{stop_latency * 1000:.0f} ms after the stop request')
+
+            await self.collect_purchase_verifications(wait=True)
+            if self._flush_task is not None:
+                await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._step_executor.shutdown(wait=False, cancel_futures=True)
+            if self.debug_screenshot and self._stop_event.is_set(): self.debug_recorder.dump('stop')
+            self.debug_recorder.close()
+
             if hint: hint.destroy()
+            self.statistic_calculator.save_snapshot()
             self.statistic_calculator.write_to_csv()
+            self.statistic_calculator.write_events()
+            print(f'Downtime: {self.statistic_calculator.downtime:.1f}s')
+            print(f'Purchase mismatches: {self.statistic_calculator.purchase_mismatches}')
+            refreshes = max(1, self.statistic_calculator.refresh_count)
+            print(f'Idle per refresh: {self.statistic_calculator.idle_time / refreshes:.2f}s')
+            for tier, tier_stats in self.statistic_calculator.match_tiers.items():
+                print(f'Matcher {tier}: {tier_stats}')
 
             self.terminate_callback()
 
+    async def wait(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+    async def settle(self, seconds: float):
+        """Wait for the game UI to settle, counted as idle time."""
+        self.statistic_calculator.idle_time += seconds
+        await self.wait(seconds)
+
+    async def flush_session(self):
+        """Start writing the snapshot and the event log in the background, after the previous write finished."""
+        if self._flush_task is not None:
+            try:
+                await self._flush_task
+            except Exception as e:
+                print(f'Failed to save the session: {e}')
+        self._flush_task = asyncio.create_task(asyncio.to_thread(self.write_session))
+
+    def write_session(self):
+        self.statistic_calculator.save_snapshot()
+        self.statistic_calculator.write_events()
+
+    async def step(self, action: Callable, *args, timeout: float = None):
+        """
+        Run a blocking step (capture, matching) off the event loop, with a deadline. A step that misses it
+        returns None: a missing frame goes to the watchdog like an unexpected screen, the session goes on.
+        Steps run one at a time on a single worker, they share the feature detector and the matcher stats.
+        A step that missed its deadline keeps the worker until it returns, the next step waits for it up to
+        its own deadline and is skipped (None) if it is still running.
+        """
+        timeout = timeout or self.step_timeout
+        if self._late_step is not None and not self._late_step.done():
+            _, pending = await asyncio.wait({self._late_step}, timeout=timeout)
+            if pending:
+                self.statistic_calculator.log_event('step skipped', f'{action.__name__}: a late step is still running')
+                return None
+        future = self._step_executor.submit(action, *args)
+        result = asyncio.wrap_future(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(result), timeout)
+        except asyncio.TimeoutError:
+            # a step that has not started yet is dropped, a running one cannot be interrupted
+            if not future.cancel():
+                self._late_step = result
+                result.add_done_callback(self._late_step_done)
+            self.statistic_calculator.log_event('timeout', f'{action.__name__} took longer than {timeout}s')
+            if self.debug_screenshot: self.debug_recorder.dump('timeout')
+            return None
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    def _late_step_done(self, result: asyncio.Future):
+        if not result.cancelled() and result.exception() is not None:
+            self.statistic_calculator.log_event('late step failed', repr(result.exception()))
+
+    async def capture(self) -> np.ndarray | None:
+        return await self.step(self.take_screenshot_mss)
+
+    async def move_to(self, x, y, duration: float, drag=False):
+        """Animate the mouse in small steps, so a stop request does not wait for the whole movement."""
+        start_x, start_y = pyautogui.position()
+        steps = max(1, int(duration / MOUSE_STEP))
+        for i in range(1, steps + 1):
+            step_x, step_y = start_x + (x - start_x) * i / steps, start_y + (y - start_y) * i / steps
+            if drag:
+                # moveTo sends plain mouse moved events even with the button held, macOS only scrolls on drag events
+                pyautogui.dragTo(step_x, step_y, button='left', mouseDownUp=False, _pause=False)
+            else:
+                pyautogui.moveTo(step_x, step_y, _pause=False)
+            await self.wait(duration / steps)
+
+    async def drag_to(self, x, y, duration: float):
+        pyautogui.mouseDown(button='left', _pause=False)
+        try:
+            await self.move_to(x, y, duration, drag=True)
+        finally:
+            pyautogui.mouseUp(button='left', _pause=False)
+
     def show_statistics_widget(self):
         bg_color = '#171717'
         fg_color = '#dddddd'
 
         if self.settings_window is None:
-            return None, None
+            return None, None, None
 
         hint = tk.Toplevel(self.settings_window)
         pos = self.game_window.AXPosition
@@ -484,11 +1308,15 @@ class SecretShopRefresh:
             if self.debug: print('No button found on screen:', image_path)
         return None
 
-    def add_search_item(self, path: str, name='', price=0, count=0):
+    def add_search_item(self, path: str, name='', price=0, count=0, asset_pack: AssetPack = None,
+                        scale=0.5, threshold=None):
         print("Adding search item:", name)
-        self.statistic_calculator.add_shop_item(path, name, price, count)
+        self.statistic_calculator.add_shop_item(path, name, price, count, asset_pack, scale, self.match_mode,
+                                                threshold)
+        if self.use_feature_fallback:
+            compute_item_features(self.feature_detector, self.statistic_calculator.get_inventory()[name])
 
-    def click_buy(self, item_pos):
+    async def click_buy(self, item_pos):
         if item_pos is None:
             return False
         # Calculate buy position based on item position
@@ -499,20 +1327,103 @@ class SecretShopRefresh:
         y = item_pos.y
 
         if self.debug: print('Buy item at position:', item_pos, (x, y))
-        self.click_on_point(x, y)
-        time.sleep(0.2)  # Small delay before confirming
+        # earlier purchases are checked while the mouse gets there, before this buy dialog can cover their rows
+        await asyncio.gather(self.move_to(x, y, self.mouse_sleep), self.wait_for_purchase_verifications())
+        async with self._purchase_lock:
+            await self.click_on_point(x, y, MOUSE_STEP)
+            await self.settle(0.2)  # Small delay before confirming
 
-        self.click_confirm_buy()
+            await self.click_confirm_buy()
         return True
 
-    def click_confirm_buy(self):
+    def get_row_region(self, item_pos: pyautogui.Point) -> tuple[int, int, int, int]:
+        """Window-relative region (x, y, width, height) of the shop row with the buy button at item_pos."""
+        left, top, width, height = safe_get_window_param(self.game_window)
+        row_half = int(height * 0.05)
+        x = int(width * 0.45)
+        y = max(0, int(item_pos.y - top) - row_half)
+        return x, y, width - x, min(2 * row_half, height - y)
+
+    def get_control_region(self) -> tuple[int, int, int, int]:
+        """Window-relative region below the item list (refresh button), only overlays change its brightness."""
+        _, _, width, height = safe_get_window_param(self.game_window)
+        x, y, w, h = self.control_roi
+        return int(width * x), int(height * y), int(width * w), int(height * h)
+
+    def verify_purchase(self, key: str, screenshot: np.ndarray, item_pos: pyautogui.Point):
+        """
+        Queue a check that the bought row turned into the sold out state. Runs in the background while
+        the loop goes on; results are applied by collect_purchase_verifications.
+        Only the row and the control region are captured. A dimmed control region means an overlay
+        (a buy dialog left open dims the row too), the row then never counts as sold out.
+        """
+        row, control = self.get_row_region(item_pos), self.get_control_region()
+        before, control_before = (float(np.mean(screenshot[y:y + h, x:x + w])) for x, y, w, h in (row, control))
+        # settle time counts from the purchase, the confirm click already waited about mouse_sleep
+        check_time = time.time() + max(0.0, self.screenshot_sleep - self.mouse_sleep)
+
+        async def check_sold_out() -> bool:
+            await self.wait(max(0.0, check_time - time.time()))
+            async with self._purchase_lock:
+                regions = await self.step(self.take_regions_mss, row, control)
+            if regions is None:
+                raise TimeoutError('capture timed out')
+            after, control_after = (float(np.mean(region)) for region in regions)
+            overlay = control_after <= control_before * self.sold_out_dimming
+            if self.debug: print(f'Verify {key}: overlay {overlay}, row brightness {before:.1f} -> {after:.1f}')
+            return not overlay and after <= before * self.sold_out_dimming
+
+        self._pending_verifications.append((key, asyncio.create_task(check_sold_out())))
+
+    async def collect_purchase_verifications(self, wait=False) -> bool:
+        """
+        Apply finished purchase checks: purchases that did not happen are taken back from the item count.
+        Returns True if any count changed.
+        """
+        if wait:
+            await self.wait_for_purchase_verifications()
+
+        changed = False
+        pending = []
+        inventory = self.statistic_calculator.get_inventory()
+
+        for key, task in self._pending_verifications:
+            if not task.done():
+                if wait:
+                    self.statistic_calculator.log_event('verification error', f'{key}: timed out')
+                else:
+                    pending.append((key, task))
+                continue
+            try:
+                sold_out = task.result()
+            except (Exception, asyncio.CancelledError) as e:
+                self.statistic_calculator.log_event('verification error', f'{key}: {e!r}')
+                continue
+            if not sold_out:
+                inventory[key].count -= 1
+                self.statistic_calculator.purchase_mismatches += 1
+                self.statistic_calculator.log_event('purchase mismatch', f'{key} was not sold out after buying')
+                if self.debug_screenshot: self.debug_recorder.dump('purchase-mismatch')
+                changed = True
+
+        self._pending_verifications = pending
+        return changed
+
+    async def wait_for_purchase_verifications(self):
+        """Wait for the pending purchase checks, checks that miss the deadline are cancelled."""
+        if self._pending_verifications:
+            _, late = await asyncio.wait([task for _, task in self._pending_verifications], timeout=self.step_timeout)
+            for task in late:
+                task.cancel()
+
+    async def click_confirm_buy(self):
         left, top, width, height = safe_get_window_param(self.game_window)
         x = left + width * 0.55
         y = top + height * 0.70
         if self.debug: print('Confirm buy at position:', (x, y))
-        self.click_on_point(x, y)
+        await self.click_on_point(x, y)
 
-    def click_button(self, button_url):
+    async def click_button(self, button_url):
         path = get_relative_path(button_url)
         button_center = self.safe_locate_center_button_on_game_window(path)
         if self.debug: save_debug_screenshot(path, center=button_center)
@@ -520,38 +1431,90 @@ class SecretShopRefresh:
 
         if self.debug: print('Found button at:', button_center)
 
-        self.click_on_point(button_center.x, button_center.y)
+        await self.click_on_point(button_center.x, button_center.y)
 
-    def click_on_point(self, x, y):
+    async def click_on_point(self, x, y, move_time: float = None):
         rand_x = random.randint(-3, 3) + x
         rand_y = random.randint(-3, 3) + y
 
-        pyautogui.moveTo(rand_x, rand_y, duration=self.mouse_sleep)
+        await self.move_to(rand_x, rand_y, self.mouse_sleep if move_time is None else move_time)
         if self.debug: print('Moving to:', (rand_x, rand_y))
 
-        pyautogui.click(rand_x, rand_y, interval=self.mouse_sleep)
+        pyautogui.click(rand_x, rand_y, _pause=False)
         if self.debug: print('Clicked at:', (rand_x, rand_y))
 
-        time.sleep(random.uniform(self.mouse_sleep - 0.1, self.mouse_sleep + 0.1))
+        await self.settle(random.uniform(self.mouse_sleep - 0.1, self.mouse_sleep + 0.1))
 
-    def click_refresh(self):
+    async def click_refresh(self) -> np.ndarray | None:
+        """
+        Click refresh and confirm it. Returns a frame of the new, settled shop list, or None if the confirm
+        dialog did not open or the shop list did not change after confirming (the refresh is not counted).
+        """
         if self._stop_event.is_set():  # Check for stop at start
-            return
+            return None
+
+        before = await self.capture()
+        if before is None:
+            return None
 
         if self.debug: print('Clicking refresh button...')
         left, top, width, height = safe_get_window_param(self.game_window)
         x = left + width * 0.20
         y = top + height * 0.90
 
-        self.click_on_point(x, y)
+        await self.click_on_point(x, y)
 
         if self._stop_event.is_set():  # Check for stop at start
-            return
+            return None
 
-        if self.debug: time.sleep(1)
-        self.click_confirm_refresh()
+        if self.debug: await self.settle(1)
 
-    def click_confirm_refresh(self):
+        dialog = await self.capture()
+        learning = not self.watchdog.knows(ScreenState.CONFIRM_DIALOG)
+        if learning and dialog is not None:
+            # first refresh: any change may be the confirm dialog, it is only learned once confirming refreshed
+            changed = self.watchdog.list_changed(before, dialog, self.list_roi)
+            state = ScreenState.UNKNOWN if changed else ScreenState.SHOP_LIST
+        else:
+            state = self.watchdog.classify(dialog)
+
+        if state != (ScreenState.UNKNOWN if learning else ScreenState.CONFIRM_DIALOG):
+            self.statistic_calculator.log_event('refresh skipped', f'confirm dialog not shown ({state})')
+            return None
+
+        await self.click_confirm_refresh()
+        if self._stop_event.is_set():
+            return None
+
+        new_list = await self.wait_for_new_list(before, self.watchdog.crop(dialog, self.watchdog.confirm_roi))
+        if new_list is None:
+            self.statistic_calculator.log_event('refresh not confirmed', 'shop list did not change')
+            return None
+
+        if learning:
+            self.watchdog.learn(ScreenState.CONFIRM_DIALOG, dialog)
+        return new_list
+
+    async def wait_for_new_list(self, before: np.ndarray, dialog_template: np.ndarray) -> np.ndarray | None:
+        """
+        Poll until the confirm dialog is gone and the item list differs from the one before refreshing, then until
+        it stops moving (two polls in a row show the same list). Returns the last frame, or None if the list did
+        not change within the sliding time. A list that changed but kept moving is returned at the deadline.
+        """
+        deadline = time.time() + max(0.7 + self.screenshot_sleep, 1) + self.screenshot_sleep
+        previous = None
+        while time.time() < deadline:
+            await self.settle(self.poll_interval)
+            screenshot = await self.capture()
+            if (screenshot is None or self.watchdog.shows_confirm(screenshot, dialog_template)
+                    or not self.watchdog.list_changed(before, screenshot, self.list_roi)):
+                continue
+            if previous is not None and not self.watchdog.list_changed(previous, screenshot, self.list_roi):
+                return screenshot
+            previous = screenshot
+        return previous
+
+    async def click_confirm_refresh(self):
         left, top, width, height = safe_get_window_param(self.game_window)
 
         x = left + width * 0.58
@@ -560,49 +1523,138 @@ class SecretShopRefresh:
         if self._stop_event.is_set():  # Check for stop at start
             return
 
-        self.click_on_point(x, y)
-
-        time.sleep(random.uniform(self.screenshot_sleep - 0.1, self.screenshot_sleep + 0.1))
+        await self.click_on_point(x, y)
 
-    def scroll_down(self):
+    async def ensure_shop_list(self, screenshot: np.ndarray) -> np.ndarray | None:
+        """
+        Check that the frame shows the shop list. Otherwise click the dismiss points (never a confirm button,
+        a leftover refresh dialog is cancelled too), pause after too many failed attempts and stop the session
+        after max_pauses pauses. A missing frame is only recaptured: the back button leaves the Secret Shop
+        if the list is on screen after all. Records the downtime. Returns a shop list frame or None if stopped.
+        """
+        state = self.watchdog.classify(screenshot)
+        if state == ScreenState.SHOP_LIST:
+            return screenshot
+
+        self.statistic_calculator.log_event('anomaly', f'unexpected screen: {state}')
+        if self.debug_screenshot: self.debug_recorder.dump('anomaly')
+        started = time.time()
+        attempt = 0
+        pauses = 0
+        recaptures = 0
+        backoff = self.poll_interval
+
+        while state != ScreenState.SHOP_LIST and not self._stop_event.is_set():
+            if state == ScreenState.NO_FRAME and recaptures < self.watchdog.max_recaptures:
+                await self.wait(backoff)
+                backoff *= 2
+                recaptures += 1
+            elif state != ScreenState.NO_FRAME and attempt < self.watchdog.max_recoveries:
+                left, top, width, height = safe_get_window_param(self.game_window)
+                fx, fy = self.watchdog.recovery_points[attempt % len(self.watchdog.recovery_points)]
+                await self.click_on_point(left + width * fx, top + height * fy)
+                attempt += 1
+                await self.settle(self.screenshot_sleep)
+            elif pauses < self.watchdog.max_pauses:
+                self.statistic_calculator.log_event('pause', f'recovery failed, waiting {self.watchdog.pause_time}s')
+                await self.wait(self.watchdog.pause_time)
+                pauses += 1
+                attempt = 0
+                recaptures = 0
+                backoff = self.poll_interval
+                await self.settle(self.screenshot_sleep)
+            else:
+                self.statistic_calculator.log_event('gave up', f'still on {state} after {pauses} pauses')
+                self._stop_event.set()
+                break
+
+            screenshot = await self.capture()
+            state = self.watchdog.classify(screenshot)
+            if state != ScreenState.NO_FRAME:
+                recaptures = 0
+                backoff = self.poll_interval
+
+        downtime = time.time() - started
+        self.statistic_calculator.add_downtime(downtime)
+        self.statistic_calculator.log_event('recovered' if state == ScreenState.SHOP_LIST else 'stopped',
+                                            f'downtime {downtime:.1f}s')
+        return screenshot if state == ScreenState.SHOP_LIST else None
+
+    async def scroll_down(self):
         left, top, width, height = safe_get_window_param(self.game_window)
 
         start_x = left + width * 0.58
         start_y = top + height * 0.65
         end_y = start_y - height * 0.5
 
-        pyautogui.moveTo(start_x, start_y, duration=0.2)
-        pyautogui.dragTo(start_x, end_y, duration=0.5, button='left')
-        time.sleep(max(0.3, self.screenshot_sleep) + 0.1)
+        # rows only move once the drag starts, pending purchase checks finish while the mouse gets there
+        await asyncio.gather(self.move_to(start_x, start_y, 0.2), self.wait_for_purchase_verifications())
+        await self.drag_to(start_x, end_y, 0.5)
+        await self.settle(max(0.3, self.screenshot_sleep) + 0.1)
 
-    def scroll_up(self):
+    async def scroll_up(self):
         left, top, width, height = safe_get_window_param(self.game_window)
 
         start_x = left + width * 0.58
         start_y = top + height * 0.65
         end_y = start_y + height * 0.5
 
-        pyautogui.moveTo(start_x, start_y, duration=0.2)
-        pyautogui.dragTo(start_x, end_y, duration=0.5, button='left')
-        time.sleep(max(0.3, self.screenshot_sleep))
-
-    def search_item(self, screenshot, item: ShopItem) -> pyautogui.Point | None:
+        await self.move_to(start_x, start_y, 0.2)
+        await self.drag_to(start_x, end_y, 0.5)
+        await self.settle(max(0.3, self.screenshot_sleep))
 
+    def search_items(self, screenshot, items: list[ShopItem]) -> list[pyautogui.Point | None]:
+        # blur once for all items, list keypoints are computed once on the first uncertain match
         process_screenshot = cv2.GaussianBlur(screenshot, (3, 3), 0)
-        process_item = cv2.GaussianBlur(item.search_image, (3, 3), 0)
-
-        left, top, width, height = safe_get_window_param(self.game_window)
+        list_features = {}
+        return [self.search_item(screenshot, item, process_screenshot, list_features) for item in items]
 
-        result = cv2.matchTemplate(process_screenshot, process_item, cv2.TM_CCOEFF_NORMED)
+    def compute_list_features(self, screenshot) -> tuple[int, tuple]:
+        """ORB keypoints of the item list area and the y of that area in the frame."""
+        roi_x, roi_y = int(screenshot.shape[1] * self.list_roi[0]), int(screenshot.shape[0] * self.list_roi[1])
+        roi = screenshot[roi_y:roi_y + int(screenshot.shape[0] * self.list_roi[3]),
+                         roi_x:roi_x + int(screenshot.shape[1] * self.list_roi[2])]
+        return roi_y, self.feature_detector.detectAndCompute(roi, None)
 
-        if self.debug_screenshot: self.debug_search(item, process_item, process_screenshot, result)
+    def search_item(self, screenshot, item: ShopItem, process_screenshot=None,
+                    list_features: dict = None) -> pyautogui.Point | None:
 
-        loc = np.where(result >= 0.8)
+        if process_screenshot is None:
+            process_screenshot = cv2.GaussianBlur(screenshot, (3, 3), 0)
 
+        left, top, width, height = safe_get_window_param(self.game_window)
 
-        if loc[0].size > 0:
+        tiers = self.statistic_calculator.match_tiers
+        started = time.perf_counter()
+        result = match_item(process_screenshot, item, self.match_mode)
+
+        loc = np.where(result >= item.threshold)
+        tiers['template'].record(loc[0].size > 0, time.perf_counter() - started)
+
+        best_score = float(result.max())
+        near_miss = loc[0].size == 0 and best_score >= item.threshold - MATCH_MODES[self.match_mode][3]
+
+        match_y = loc[0][0] if loc[0].size > 0 else None
+        if near_miss and self.use_feature_fallback:
+            # uncertain frame, try the keypoint matcher on the item list only
+            started = time.perf_counter()
+            if list_features is None:
+                list_features = {}
+            if 'keypoints' not in list_features:
+                list_features['roi_y'], list_features['keypoints'] = self.compute_list_features(screenshot)
+            roi_match_y = match_item_features(list_features['keypoints'], item)
+            if roi_match_y is not None:
+                match_y = list_features['roi_y'] + roi_match_y
+            tiers['features'].record(match_y is not None, time.perf_counter() - started)
+
+        if self.debug_screenshot:
+            self.debug_recorder.record(item.path, match_map=result, best_score=best_score, threshold=item.threshold,
+                                       match_y=None if match_y is None else int(match_y))
+            if near_miss and match_y is None: self.debug_recorder.dump('miss')
+
+        if match_y is not None:
             x = left + width * 0.90
-            y = top + loc[0][0] + height * 0.085
+            y = top + match_y + height * 0.085
             pos = pyautogui.Point(x, y)
             return pos
         return None
@@ -632,25 +1684,6 @@ class SecretShopRefresh:
         #     pos = pyautogui.Point(buy_button_x, item_center_y_screen)
         #     return pos
 
-    def debug_search(self, item: ShopItem, process_item: Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]] | UMat,
-                     process_screenshot: Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]] | UMat,
-                     result: Mat | ndarray[Any, dtype[integer[Any] | floating[Any]]]):
-        # Save processed images and match result for debugging
-        try:
-            os.makedirs('debug_screenshots', exist_ok=True)
-            timestamp = int(time.time() * 1000)
-            base_name = f"debug_screenshots/{timestamp}_{os.path.basename(item.path).replace('.', '_')}"
-            cv2.imwrite(base_name + "_screenshot.png", process_screenshot)
-            cv2.imwrite(base_name + "_item.png", process_item)
-            norm = cv2.normalize(result, None, 0, 255, cv2.NORM_MINMAX)
-            heatmap = np.uint8(norm)
-            heatmap_color = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-            cv2.imwrite(base_name + "_result.png", heatmap_color)
-
-        except Exception as e:
-            if self.debug:
-                print("Failed to save processed debug images:", e)
-
 
 class RefresherGUI:
     def __init__(self):
@@ -661,8 +1694,8 @@ class RefresherGUI:
         #  init settings window
         self.settings_window.config(bg=self.app_config.unite_bg_color)
         self.settings_window.title('SHOP AUTO REFRESH')
-        self.settings_window.geometry('420x745')
-        self.settings_window.minsize(420, 745)
+        self.settings_window.geometry('420x780')
+        self.settings_window.minsize(420, 780)
         self.permanent_icons = []
 
         self.settings_window.bind_all('<Escape>', self.stop_shop_refresh)
@@ -704,7 +1737,11 @@ class RefresherGUI:
             item_checkbox.pack(side=tk.LEFT)
             if path not in self.app_config.skip_items:
                 item_checkbox.select()
-            icon = ImageTk.PhotoImage(image=Image.open(get_relative_path(path)))
+            arrays = self.app_config.asset_pack.get_arrays(path) if self.app_config.asset_pack else None
+            if arrays is not None:
+                icon = ImageTk.PhotoImage(image=Image.fromarray(arrays['icon']))
+            else:
+                icon = ImageTk.PhotoImage(image=Image.open(get_relative_path(path)))
             self.permanent_icons.append(icon)
 
             image_label = tk.Label(master=frame, image=icon, bg='#FFBF00')
@@ -766,6 +1803,13 @@ class RefresherGUI:
                                                     self.app_config.budget)
         self.limit_spend_entry.config(validate='key', validatecommand=(validate_integer_command, '%P'))
 
+        self.resume_value = tk.IntVar()
+        tk.Checkbutton(master=additional_setting_frame, variable=self.resume_value,
+                       text='Resume last session',
+                       bg=self.app_config.unite_bg_color,
+                       fg=self.app_config.unite_text_color,
+                       font=('Helvetica', 12)).pack(pady=4)
+
         additional_setting_frame.pack()
 
         ## Step 4 profit
@@ -818,11 +1862,19 @@ class RefresherGUI:
                                      debug=self.app_config.DEBUG)
 
         self.ssr.settings_window = self.settings_window
+        self.ssr.debug_screenshot = self.app_config.debug_screenshot
+        self.ssr.debug_recorder = DebugRecorder(self.app_config.debug_buffer_size,
+                                                max_bytes=self.app_config.debug_buffer_mb * 1024 * 1024)
+        self.ssr.match_mode = self.app_config.match_mode
+        self.ssr.use_feature_fallback = self.app_config.use_feature_fallback
 
         # setting item to search while refreshing
         for item in self.app_config.ALL_ITEMS:
             if item[0] not in self.app_config.skip_items:
-                self.ssr.add_search_item(path=item[0], name=item[1], price=item[2])
+                self.ssr.add_search_item(path=item[0], name=item[1], price=item[2],
+                                         asset_pack=self.app_config.asset_pack,
+                                         scale=self.app_config.template_scale,
+                                         threshold=self.app_config.match_threshold)
 
         # setting additional settings
         self.ssr.mouse_sleep = float(
@@ -839,6 +1891,7 @@ class RefresherGUI:
         # setting up skystone budget
         if self.limit_spend_entry.get() != '':
             self.ssr.budget = int(self.limit_spend_entry.get())
+        self.ssr.resume = self.resume_value.get() == 1
 
         print('refresh shop start!')
         print('Budget:', self.ssr.budget)
@@ -848,4 +1901,22 @@ class RefresherGUI:
 
 
 if __name__ == '__main__':
-    RefresherGUI()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Epic Seven secret shop refresher')
+    parser.add_argument('command', nargs='?', default='gui', choices=['gui', 'build-pack', 'bench-match'],
+                        help='build-pack compiles assets/ into %s, bench-match compares match modes' % ASSET_PACK_FILE)
+    parser.add_argument('corpus', nargs='?', help='bench-match: folder with frames and labels.csv')
+    parser.add_argument('--recall', type=float, default=0.98, help='bench-match: recall target')
+    parser.add_argument('--max-false-positives', type=int, default=0,
+                        help='bench-match: false positives allowed in the recommendation')
+    args = parser.parse_args()
+
+    if args.command == 'build-pack':
+        build_asset_pack(AppConfig(load_pack=False))
+    elif args.command == 'bench-match':
+        if not args.corpus:
+            parser.error('bench-match needs a corpus folder')
+        benchmark_matching(args.corpus, AppConfig(), args.recall, max_false_positives=args.max_false_positives)
+    else:
+        RefresherGUI()
@@ -0,0 +1,552 @@
+"""
+Soak test for the refresh loop.
+
+Runs SecretShopRefresh.shop_refresh_loop end-to-end against a simulated secret shop: find_window, the mss capture
+path and pyautogui are replaced by stand-ins that render synthetic frames (random item placement, scroll offset,
+rendering delay, occasional popups) and react to clicks. Time is virtual, so thousands of refreshes run in minutes.
+mss, pyautogui and atomacos are stand-in modules from the start, so the soak test runs on any OS.
+
+Checks that refresh count, item counts and spend match what the simulated shop actually sold, measures
+refreshes/sec, memory and the Tk images and widgets of the statistics widget over time (the widget needs a display
+and is left out without one) and stores the results in ShopRefreshHistory/soak_results.jsonl so runs can be
+compared with earlier ones.
+
+    python ShopSimulator.py --cycles 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tkinter as tk
+import tracemalloc
+import types
+from collections import namedtuple
+from datetime import datetime
+
+import cv2
+import numpy as np
+from PIL import ImageTk
+
+
+def install_stand_in_modules():
+    """
+    Register stand-ins for mss, pyautogui and atomacos before ShopRefresher imports them: the real ones need a
+    display (and macOS for atomacos). run_soak replaces what ShopRefresher uses of them for each run.
+    """
+    def not_simulated(*args, **kwargs):
+        raise RuntimeError('not available in the soak test')
+
+    stand_ins = {
+        'mss': {'mss': not_simulated},
+        'pyautogui': {'Point': namedtuple('Point', 'x y')},
+        'atomacos': {'NativeUIElement': type('NativeUIElement', (), {}), 'getAppRefByBundleId': not_simulated},
+    }
+    for name, attributes in stand_ins.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+
+install_stand_in_modules()
+
+import ShopRefresher as sr  # noqa: E402  (needs the stand-in modules)
+
+
+class VirtualClock:
+    """Replacement for the time module used by ShopRefresher: sleeping only moves the clock forward."""
+    perf_counter = staticmethod(time.perf_counter)
+
+    def __init__(self):
+        self.now = 0.0
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += max(0.0, seconds)
+
+    async def wait(self, seconds):
+        """Replacement for SecretShopRefresh.wait, still yields to the event loop."""
+        self.sleep(seconds)
+        await asyncio.sleep(0)
+
+
+class FakeWindow:
+    def __init__(self, left, top, width, height):
+        self.AXPosition = (left, top)
+        self.AXSize = (width, height)
+
+
+class FakeMss:
+    """Stand-in for the mss module, grabs come from the simulated shop."""
+    def __init__(self, shop: 'SimulatedShop'):
+        self.shop = shop
+
+    def mss(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def grab(self, monitor):
+        return self.shop.grab(monitor)
+
+
+class FakePyAutoGUI:
+    """
+    Stand-in for pyautogui, mouse animations and the PAUSE after every call only advance the virtual clock.
+    Like pyautogui on macOS, only dragTo sends drag events: moving with moveTo while the button is held does
+    not scroll the list.
+    """
+    Point = namedtuple('Point', 'x y')
+    PAUSE = 0.1
+
+    def __init__(self, shop: 'SimulatedShop', clock: VirtualClock):
+        self.shop = shop
+        self.clock = clock
+        self.x, self.y = 0, 0
+        self.button_down = False
+        self.drag_start_y = None
+
+    def pause(self, _pause):
+        if _pause:
+            self.clock.sleep(self.PAUSE)
+
+    def position(self):
+        return self.Point(self.x, self.y)
+
+    def moveTo(self, x, y, duration=0.0, _pause=True):
+        self.clock.sleep(duration)
+        self.x, self.y = x, y
+        self.pause(_pause)
+
+    def dragTo(self, x, y, duration=0.0, button='left', mouseDownUp=True, _pause=True):
+        if mouseDownUp:
+            self.mouseDown(button, _pause=False)
+        if self.button_down and self.drag_start_y is None:
+            self.drag_start_y = self.y
+        self.moveTo(x, y, duration, _pause=False)
+        if mouseDownUp:
+            self.mouseUp(button, _pause=False)
+        self.pause(_pause)
+
+    def click(self, x, y, _pause=True):
+        self.moveTo(x, y, _pause=False)
+        self.shop.click(x, y)
+        self.pause(_pause)
+
+    def mouseDown(self, button='left', _pause=True):
+        self.button_down = True
+        self.pause(_pause)
+
+    def mouseUp(self, button='left', _pause=True):
+        if self.drag_start_y is not None:
+            self.shop.drag(self.drag_start_y, self.y)
+        self.button_down = False
+        self.drag_start_y = None
+        self.pause(_pause)
+
+
+class SimulatedShop:
+    """
+    Secret shop state machine with the same layout the refresher expects: six rows, four visible at a time,
+    refresh button at (0.2, 0.9), refresh confirm at (0.58, 0.65), buy button at 0.9 of the width and buy confirm
+    at (0.55, 0.70). Bought rows turn dim (sold out). Dialogs and popups close on their cancel button, the back
+    button at (0.03, 0.05) or a click outside of them. Like in the game, the back button on the list leaves the
+    Secret Shop, there is no way back from the lobby. Changes become visible after a random rendering delay.
+    """
+    LIST, CONFIRM_REFRESH, CONFIRM_BUY, POPUP, LOBBY = 'list', 'confirm refresh', 'confirm buy', 'popup', 'lobby'
+    # x0, y0, x1, y1 of the dialog boxes and (confirm, cancel) button centres, relative to the window
+    BOXES = {
+        CONFIRM_REFRESH: ((0.25, 0.30, 0.75, 0.78), (0.58, 0.65), (0.42, 0.65)),
+        CONFIRM_BUY: ((0.25, 0.25, 0.75, 0.82), (0.55, 0.70), (0.40, 0.70)),
+        POPUP: ((0.15, 0.20, 0.85, 0.80), None, None),
+    }
+
+    def __init__(self, items: list[sr.ShopItem], clock: VirtualClock, rng: random.Random,
+                 left=100, top=50, width=900, height=520, rows=6, item_chance=0.3, popup_chance=0.01,
+                 max_render_delay=0.2, miss_chance=0.0):
+        self.items = items
+        self.clock = clock
+        self.rng = rng
+        self.window = FakeWindow(left, top, width, height)
+        self.left, self.top, self.width, self.height = left, top, width, height
+        self.row_count = rows
+        self.item_chance = item_chance
+        self.popup_chance = popup_chance
+        # chance that a click does not register, like a tap the game drops
+        self.miss_chance = miss_chance
+        self.max_render_delay = max_render_delay
+
+        self.list_top = int(height * 0.1)
+        self.list_bottom = int(height * 0.9)
+        self.row_height = int(height * 0.2)
+
+        noise = np.random.default_rng(rng.randrange(2 ** 32))
+        self.background = (np.full((height, width), 60) + noise.integers(0, 16, (height, width))).astype(np.uint8)
+        icon_shape = items[0].search_image.shape
+        self.fillers = [noise.integers(0, 256, icon_shape).astype(np.uint8) for _ in range(8)]
+        # name and price text of a row
+        self.labels = [np.where(noise.random((14, int(width * 0.25))) < 0.4, 230, 100).astype(np.uint8)
+                       for _ in range(32)]
+
+        # ground truth
+        self.refreshes = 0
+        self.counts = {item.path: 0 for item in items}
+        self.spent = 0
+        self.missed = 0
+        self.dropped_clicks = 0
+        self.popups = 0
+        self.left_shop = 0
+        self.on_refresh = None
+
+        self.state = self.LIST
+        self.buy_row = None
+        self.scroll = 0
+        self.rows = []
+        self._frame = None
+        self._previous_frame = None
+        self._shown_at = 0.0
+        self.new_shop()
+        self._lock = threading.Lock()
+
+    def new_shop(self):
+        self.rows = [{'item': None, 'filler': self.rng.randrange(len(self.fillers)),
+                      'label': self.rng.randrange(len(self.labels)), 'sold': False}
+                     for _ in range(self.row_count)]
+        for item in self.items:
+            if self.rng.random() < self.item_chance:
+                free = [row for row in self.rows if row['item'] is None]
+                self.rng.choice(free)['item'] = item
+        self.scroll = 0
+
+    def change(self, state):
+        """Switch state; the frame on screen stays the old one for a random rendering delay."""
+        self._previous_frame = self.visible_frame()
+        self.state = state
+        self._frame = None
+        self._shown_at = self.clock.time() + self.rng.uniform(0, self.max_render_delay)
+
+    def row_top(self, index):
+        return self.list_top + index * self.row_height - self.scroll
+
+    def row_at(self, y):
+        index = (y - self.list_top + self.scroll) // self.row_height
+        if 0 <= index < self.row_count and self.list_top <= y < self.list_bottom:
+            return int(index)
+        return None
+
+    def render(self) -> np.ndarray:
+        frame = self.background.copy()
+        icon_x = int(self.width * 0.1)
+        for index, row in enumerate(self.rows):
+            top = self.row_top(index)
+            y0, y1 = max(top + 2, self.list_top), min(top + self.row_height - 2, self.list_bottom)
+            if y0 >= y1:
+                continue
+            frame[y0:y1, int(self.width * 0.05):int(self.width * 0.95)] = 100
+            icon = row['item'].search_image if row['item'] else self.fillers[row['filler']]
+            iy = top + 20
+            if self.list_top <= iy and iy + icon.shape[0] <= self.list_bottom:
+                frame[iy:iy + icon.shape[0], icon_x:icon_x + icon.shape[1]] = icon
+            label = self.labels[row['label']]
+            ly, lx = top + 30, int(self.width * 0.25)
+            if self.list_top <= ly and ly + label.shape[0] <= self.list_bottom:
+                frame[ly:ly + label.shape[0], lx:lx + label.shape[1]] = label
+            if row['sold']:
+                frame[y0:y1] //= 2
+
+        if self.state in (self.CONFIRM_REFRESH, self.CONFIRM_BUY):
+            frame //= 2
+            (x0, y0, x1, y1), confirm, cancel = self.BOXES[self.state]
+            frame[int(self.height * y0):int(self.height * y1), int(self.width * x0):int(self.width * x1)] = 200
+            for (bx, by), shade in ((confirm, 90), (cancel, 150)):
+                self.fill(frame, bx - 0.08, by - 0.04, bx + 0.08, by + 0.04, shade)
+                self.fill(frame, bx - 0.05, by - 0.01, bx + 0.05, by + 0.01, 240)
+            if self.state == self.CONFIRM_BUY and self.rows[self.buy_row]['item'] is not None:
+                icon = self.rows[self.buy_row]['item'].search_image
+                iy, ix = int(self.height * 0.35), int(self.width * 0.45)
+                frame[iy:iy + icon.shape[0], ix:ix + icon.shape[1]] = icon
+        elif self.state == self.POPUP:
+            frame[:] = 30
+            (x0, y0, x1, y1), _, _ = self.BOXES[self.POPUP]
+            frame[int(self.height * y0):int(self.height * y1), int(self.width * x0):int(self.width * x1)] = 230
+        elif self.state == self.LOBBY:
+            frame = self.background.copy()
+            self.fill(frame, 0.0, 0.6, 1.0, 1.0, 180)
+        return frame
+
+    def fill(self, frame, x0, y0, x1, y1, value):
+        frame[int(self.height * y0):int(self.height * y1), int(self.width * x0):int(self.width * x1)] = value
+
+    def visible_frame(self) -> np.ndarray:
+        if self._previous_frame is not None and self.clock.time() < self._shown_at:
+            return self._previous_frame
+        if self._frame is None:
+            self._frame = self.render()
+        return self._frame
+
+    def grab(self, monitor) -> np.ndarray:
+        with self._lock:
+            frame = self.visible_frame()
+        x, y = monitor['left'] - self.left, monitor['top'] - self.top
+        return cv2.cvtColor(frame[y:y + monitor['height'], x:x + monitor['width']], cv2.COLOR_GRAY2BGRA)
+
+    def near(self, x, y, fx, fy, tolerance=0.04):
+        return (abs(x - self.width * fx) <= self.width * tolerance
+                and abs(y - self.height * fy) <= self.height * tolerance)
+
+    def click(self, x, y):
+        x, y = x - self.left, y - self.top
+        with self._lock:
+            if self.miss_chance and self.rng.random() < self.miss_chance:
+                self.dropped_clicks += 1
+                return
+            if self.state == self.LOBBY:
+                return
+            if self.state == self.LIST:
+                if self.near(x, y, 0.03, 0.05):
+                    self.left_shop += 1
+                    self.change(self.LOBBY)
+                elif self.near(x, y, 0.20, 0.90):
+                    self.change(self.CONFIRM_REFRESH)
+                elif abs(x - self.width * 0.90) <= self.width * 0.04 and self.row_at(y) is not None:
+                    self.buy_row = self.row_at(y)
+                    self.change(self.CONFIRM_BUY)
+                return
+
+            (x0, y0, x1, y1), confirm, cancel = self.BOXES[self.state]
+            inside = x0 * self.width <= x < x1 * self.width and y0 * self.height <= y < y1 * self.height
+            if confirm and self.near(x, y, *confirm):
+                if self.state == self.CONFIRM_REFRESH:
+                    self.refresh()
+                else:
+                    self.buy(self.rows[self.buy_row])
+            elif not inside or self.near(x, y, 0.03, 0.05) or (cancel and self.near(x, y, *cancel)):
+                self.change(self.LIST)
+
+    def drag(self, from_y, to_y):
+        with self._lock:
+            if self.state == self.LIST:
+                # scroll to the bottom of the list, the game does not stop at exactly the same offset every time
+                self.scroll = self.row_height * (self.row_count - 4) + self.rng.randint(-4, 4) if to_y < from_y else 0
+                self.change(self.LIST)
+
+    def buy(self, row):
+        item = row['item']
+        if item is not None and not row['sold']:
+            row['sold'] = True
+            self.counts[item.path] += 1
+            self.spent += item.price
+        self.change(self.LIST)
+
+    def refresh(self):
+        self.missed += sum(1 for row in self.rows if row['item'] is not None and not row['sold'])
+        self.refreshes += 1
+        self.new_shop()
+        if self.rng.random() < self.popup_chance:
+            self.popups += 1
+            self.change(self.POPUP)
+        else:
+            self.change(self.LIST)
+        if self.on_refresh:
+            self.on_refresh(self.refreshes)
+
+
+def create_tk_root() -> tk.Tk | None:
+    """Hidden Tk root for the statistics widget, None without a display."""
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        return None
+    root.withdraw()
+    return root
+
+
+def count_tk_widgets(widget: tk.Misc) -> int:
+    return sum(1 + count_tk_widgets(child) for child in widget.winfo_children())
+
+
+def run_soak(cycles=2000, seed=1, match_mode='plain', debug_capture=False, miss_chance=0.0,
+             sample_count=50) -> dict:
+    rng = random.Random(seed)
+    random.seed(seed)
+    config = sr.AppConfig()
+    clock = VirtualClock()
+
+    items = [sr.load_shop_item(path, price=price, asset_pack=config.asset_pack, scale=config.template_scale,
+                               mode=match_mode) for path, name, price, *_ in config.ALL_ITEMS]
+    names = {item.path: name for item, (_, name, *_) in zip(items, config.ALL_ITEMS)}
+    shop = SimulatedShop(items, clock, rng, miss_chance=miss_chance)
+
+    originals = {name: getattr(sr, name) for name in ('time', 'mss', 'pyautogui', 'find_window', 'activate_game')}
+    sr.time = clock
+    sr.mss = FakeMss(shop)
+    sr.pyautogui = FakePyAutoGUI(shop, clock)
+    sr.find_window = lambda title: shop.window
+    sr.activate_game = lambda: True
+
+    root = create_tk_root()
+    if root is None:
+        print('No display, running without the statistics widget')
+
+    samples = []
+    sample_every = max(1, cycles // sample_count)
+    started = time.perf_counter()
+
+    def on_refresh(refresh_number):
+        if refresh_number % sample_every == 0:
+            tk_images = tk_widgets = 0
+            if root is not None:
+                root.update()
+                tk_images, tk_widgets = len(root.image_names()), count_tk_widgets(root)
+            samples.append((refresh_number, time.perf_counter() - started, tracemalloc.get_traced_memory()[0],
+                            tk_images, tk_widgets))
+
+    shop.on_refresh = on_refresh
+
+    try:
+        finished = threading.Event()
+        ssr = sr.SecretShopRefresh(title_name=config.app_title, terminate_callback=finished.set,
+                                   settings_window=root, budget=cycles)
+        ssr.match_mode = match_mode
+        ssr.debug_screenshot = debug_capture
+        ssr.watchdog.pause_time = 0.1
+        ssr.wait = clock.wait
+        for item in items:
+            ssr.statistic_calculator.add_item(names[item.path], item)
+            if root is not None:
+                # the widget icon, like RefreshStatistic.add_shop_item makes it
+                ssr.statistic_calculator.show_images[names[item.path]] = ImageTk.PhotoImage(
+                    sr.load_item_icon(item.path, config.asset_pack), master=root)
+
+        work_dir = os.getcwd()
+        with tempfile.TemporaryDirectory() as run_dir:
+            # keep the session CSV and debug captures out of the real history
+            os.chdir(run_dir)
+            tracemalloc.start()
+            try:
+                ssr.shop_refresh_loop()
+            finally:
+                tracemalloc.stop()
+                os.chdir(work_dir)
+    finally:
+        if root is not None:
+            root.destroy()
+        for name, value in originals.items():
+            setattr(sr, name, value)
+
+    elapsed = time.perf_counter() - started
+    statistic = ssr.statistic_calculator
+
+    # memory trend over the run (warm-up excluded), a steady slope means something keeps growing
+    growth = 0.0
+    steady = samples[len(samples) // 10:]
+    if len(steady) >= 4:
+        slope = np.polyfit([sample[0] for sample in steady], [sample[2] for sample in steady], 1)[0]
+        growth = slope * 1000 / 1024
+
+    errors = []
+    if steady and (steady[-1][3] > steady[0][3] or steady[-1][4] > steady[0][4]):
+        errors.append(f'Tk images {steady[0][3]} -> {steady[-1][3]}, widgets {steady[0][4]} -> {steady[-1][4]}')
+    if statistic.refresh_count != shop.refreshes:
+        errors.append(f'refresh count {statistic.refresh_count} != {shop.refreshes} shop refreshes')
+    for item in items:
+        if item.count != shop.counts[item.path]:
+            errors.append(f'{item.path} count {item.count} != {shop.counts[item.path]} bought')
+    if statistic.get_total_cost() != shop.spent:
+        errors.append(f'spent {statistic.get_total_cost()} != {shop.spent}')
+    if shop.left_shop:
+        errors.append(f'the refresher left the Secret Shop {shop.left_shop} times')
+    if shop.missed and not miss_chance:
+        # with dropped clicks a purchase can fail after the row was searched, leaving the item behind is expected
+        errors.append(f'{shop.missed} items were left in the shop')
+
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'cycles': cycles,
+        'seed': seed,
+        'match_mode': match_mode,
+        'debug_capture': debug_capture,
+        'miss_chance': miss_chance,
+        'dropped_clicks': shop.dropped_clicks,
+        'left_in_shop': shop.missed,
+        'left_shop': shop.left_shop,
+        'refreshes': shop.refreshes,
+        'popups': shop.popups,
+        'bought': shop.counts,
+        'spent': shop.spent,
+        'purchase_mismatches': statistic.purchase_mismatches,
+        'downtime': round(statistic.downtime, 2),
+        'idle_seconds_per_refresh': round(statistic.idle_time / max(1, shop.refreshes), 3),
+        'wall_seconds': round(elapsed, 2),
+        'virtual_seconds': round(clock.now, 2),
+        'refreshes_per_sec': round(shop.refreshes / elapsed, 2) if elapsed else 0.0,
+        'memory_kb': [round(sample[2] / 1024) for sample in samples],
+        'tk_widget': root is not None,
+        'tk_images': [sample[3] for sample in samples],
+        'tk_widgets': [sample[4] for sample in samples],
+        'memory_growth_kb_per_1000': round(growth, 1),
+        'errors': errors,
+    }
+
+
+def compare_with_previous(result: dict, history_path: str, max_slowdown: float) -> list[str]:
+    """Return regressions compared to the last stored run with the same settings."""
+    previous = None
+    if os.path.isfile(history_path):
+        with open(history_path) as file:
+            for line in file:
+                run = json.loads(line)
+                if all(run.get(key) == result[key] for key in ('cycles', 'match_mode', 'debug_capture', 'miss_chance')):
+                    previous = run
+    if previous is None:
+        print('No earlier run to compare with')
+        return []
+
+    change = result['refreshes_per_sec'] / previous['refreshes_per_sec'] - 1 if previous['refreshes_per_sec'] else 0
+    print(f'Compared with {previous["time"]}: {previous["refreshes_per_sec"]} -> {result["refreshes_per_sec"]} '
+          f'refreshes/sec ({change:+.1%}), memory growth {previous["memory_growth_kb_per_1000"]} -> '
+          f'{result["memory_growth_kb_per_1000"]} KB per 1000 refreshes')
+    if change < -max_slowdown:
+        return [f'throughput dropped by {-change:.1%}']
+    return []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Soak test for the shop refresh loop')
+    parser.add_argument('--cycles', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--match-mode', default='plain', choices=list(sr.MATCH_MODES))
+    parser.add_argument('--debug-capture', action='store_true', help='run with the debug ring buffer enabled')
+    parser.add_argument('--miss-chance', type=float, default=0.0, help='chance that the shop drops a click')
+    parser.add_argument('--max-growth-kb', type=float, default=512, help='allowed memory growth per 1000 refreshes')
+    parser.add_argument('--max-slowdown', type=float, default=0.2, help='allowed throughput drop vs the last run')
+    args = parser.parse_args()
+
+    history_path = sr.get_history_path('soak_results.jsonl')
+    result = run_soak(args.cycles, args.seed, args.match_mode, args.debug_capture, args.miss_chance)
+
+    if result['memory_growth_kb_per_1000'] > args.max_growth_kb:
+        result['errors'].append(f'memory grows {result["memory_growth_kb_per_1000"]} KB per 1000 refreshes')
+    regressions = compare_with_previous(result, history_path, args.max_slowdown)
+
+    with open(history_path, 'a') as file:
+        file.write(json.dumps(result) + '\n')
+
+    print(f'{result["refreshes"]} refreshes in {result["wall_seconds"]}s ({result["refreshes_per_sec"]}/s), '
+          f'bought {result["bought"]}, spent {result["spent"]}, {result["popups"]} popups, '
+          f'memory growth {result["memory_growth_kb_per_1000"]} KB per 1000 refreshes')
+    for error in result['errors'] + regressions:
+        print('FAILED:', error)
+    sys.exit(1 if result['errors'] or regressions else 0)